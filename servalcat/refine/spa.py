@@ -20,13 +20,17 @@ u_to_b = utils.model.u_to_b
 
 def calc_D_and_S(hkldata, lab_obs): # simplified version of fofc.calc_D_and_S()
     bdf = hkldata.binned_df
-    bdf["D"] = 0.
-    bdf["S"] = 0.
-    for i_bin, idxes in hkldata.binned():
-        Fo = hkldata.df[lab_obs].to_numpy()[idxes]
-        Fc = hkldata.df.FC.to_numpy()[idxes]
-        bdf.loc[i_bin, "D"] = numpy.nansum(numpy.real(Fo * numpy.conj(Fc))) / numpy.sum(numpy.abs(Fc)**2)
-        bdf.loc[i_bin, "S"] = numpy.nanmean(numpy.abs(Fo - bdf.D[i_bin] * Fc)**2)
+    D = numpy.zeros(len(bdf.index))
+    S = numpy.zeros(len(bdf.index))
+    FP = hkldata.df[lab_obs].to_numpy()
+    FC = hkldata.df.FC.to_numpy()
+    for i, (i_bin, idxes) in enumerate(hkldata.binned()):
+        Fo = FP[idxes]
+        Fc = FC[idxes]
+        D[i] = numpy.nansum(numpy.real(Fo * numpy.conj(Fc))) / numpy.sum(numpy.abs(Fc)**2)
+        S[i] = numpy.nanmean(numpy.abs(Fo - D[i] * Fc)**2)
+    bdf["D"] = D
+    bdf["S"] = S
 # calc_D_and_S()
 
 class LL_SPA:
@@ -84,36 +84,51 @@ $$
         var_noise = hkldata.binned_df.var_noise * 2
     elif has_halfmaps:
         var_noise = hkldata.binned_df.var_noise
-        
-    for i_bin, idxes in hkldata.binned():
-        bin_d_min = hkldata.binned_df.d_min[i_bin]
-        bin_d_max = hkldata.binned_df.d_max[i_bin]
-        Fo = FP[idxes]
-        Fc = hkldata.df.FC.to_numpy()[idxes]
-        fsc = numpy.real(numpy.corrcoef(Fo, Fc)[1,0])
-        bdf.loc[i_bin, "D"] = numpy.sum(numpy.real(Fo * numpy.conj(Fc)))/numpy.sum(numpy.abs(Fc)**2)
+
+    # reorder once so that each bin is a contiguous slice
+    order, offsets = hkldata.binned_order()
+    counts = numpy.diff(offsets)
+    FP = FP[order]
+    FC = hkldata.df.FC.to_numpy()[order]
+    moments = utils.hkl.binned_moments(FP, FC, offsets)
+    mean_fo2 = moments["mean11"]
+    mean_fc2 = moments["mean22"]
+    D = moments["mean12"] / mean_fc2
+    bdf["D"] = D
+    fsc = utils.hkl.binned_fsc(FP, FC, moments=moments)
+    std_fo = numpy.sqrt(mean_fo2 - numpy.abs(moments["mean1"])**2)
+    if has_halfmaps:
+        var_noise = var_noise.to_numpy()
+        fsc_full = bdf.FSCfull.to_numpy()
+        S = utils.hkl.binned_sum(numpy.abs(FP - numpy.repeat(D, counts) * FC)**2, offsets) / counts
+        S = numpy.maximum(0, S - var_noise)
+        bdf["S"] = S
+    else:
+        var_noise = fsc_full = S = numpy.zeros(len(counts))
+
+    d_min_all = bdf.d_min.to_numpy()
+    d_max_all = bdf.d_max.to_numpy()
+    for i, (i_bin, _) in enumerate(hkldata.binned()):
+        bin_d_min = d_min_all[i]
+        bin_d_max = d_max_all[i]
+        varn = var_noise[i]
         if has_halfmaps:
-            varn = var_noise[i_bin]
-            fsc_full = hkldata.binned_df.FSCfull[i_bin]
-            S = max(0, numpy.average(numpy.abs(Fo-bdf.D[i_bin]*Fc)**2)-varn)
-            bdf.loc[i_bin, "S"] = S
-            w = S/(S+varn)
-            if fsc_full < 0: # this should be fixed actually. needs smoothing to zero.
+            w = S[i]/(S[i]+varn)
+            if fsc_full[i] < 0: # this should be fixed actually. needs smoothing to zero.
                 w_sharpen = 0
             else:
-                w_sharpen = w / numpy.sqrt(fsc_full) / numpy.std(Fo)
+                w_sharpen = w / numpy.sqrt(fsc_full[i]) / std_fo[i]
         else:
-            varn = fsc_full = 0
             w = 1
             w_sharpen = 1
 
         with numpy.errstate(divide="ignore", invalid="ignore"):
-            stats_str += tmpl.format(1/bin_d_min**2, i_bin, Fo.size, bin_d_max, bin_d_min,
-                                     numpy.log(numpy.average(numpy.abs(Fo)**2)),
-                                     numpy.log(numpy.average(numpy.abs(Fc)**2)),
-                                     numpy.log(bdf.D[i_bin]**2*numpy.average(numpy.abs(Fc)**2)),
-                                     fsc, fsc_full, numpy.sqrt(fsc_full), bdf.D[i_bin],
-                                     numpy.log(bdf.S[i_bin]), numpy.log(varn),
+            stats_str += tmpl.format(1/bin_d_min**2, i_bin, counts[i], bin_d_max, bin_d_min,
+                                     numpy.log(mean_fo2[i]),
+                                     numpy.log(mean_fc2[i]),
+                                     numpy.log(D[i]**2*mean_fc2[i]),
+                                     fsc[i], fsc_full[i], numpy.sqrt(fsc_full[i]), D[i],
+                                     numpy.log(S[i]), numpy.log(varn),
                                      w, 1-w, w_sharpen)
     return stats_str
 # calc_D_and_S()
@@ -135,9 +150,13 @@ def calc_maps(hkldata, B=None, has_halfmaps=True, half1_only=False, no_fsc_weigh
     else:
         labs = ["DELFWT"]
         
+    # reorder once so that each bin is a contiguous slice; results are put back at the end
+    order, offsets = hkldata.binned_order()
+    counts = numpy.diff(offsets)
+    # map coefficients are only written to MTZ (float32) or FFT-ed (complex64); statistics stay in double
     tmp = {}
     for l in labs:
-        tmp[l] = numpy.zeros(len(hkldata.df.index), numpy.complex128)
+        tmp[l] = numpy.zeros(len(order), numpy.complex64)
 
     logger.writeln("Calculating maps..")
     logger.write(" sharpening method: ")
@@ -153,81 +172,92 @@ def calc_maps(hkldata, B=None, has_halfmaps=True, half1_only=False, no_fsc_weigh
     else:
         FP = hkldata.df.FP.to_numpy()
 
-    s2 = 1./hkldata.d_spacings().to_numpy()**2
+    FP = FP[order]
+    s2 = 1./hkldata.d_spacings().to_numpy()[order]**2
 
-    fsc_became_negative = False
-        
-    for i_bin, idxes in hkldata.binned():
-        if has_halfmaps:
-            fsc = hkldata.binned_df.FSCfull[i_bin] # FSCfull
-            if half1_only:
-                varn = hkldata.binned_df.var_noise[i_bin] * 2
-                fsc = fsc/(2-fsc) # to FSChalf
-            else:
-                varn = hkldata.binned_df.var_noise[i_bin]
-        else:
-            fsc, varn = 1., 0.
-            
-        w_nomodel = 1. if no_fsc_weights else fsc
-        Fo = FP[idxes]
-        sig_fo = numpy.std(Fo)
-        s2_bin = s2[idxes]
+    # per-bin parameters
+    if has_halfmaps:
+        fsc = hkldata.binned_df.FSCfull.to_numpy() # FSCfull
+        varn = hkldata.binned_df.var_noise.to_numpy()
+        if half1_only:
+            varn = varn * 2
+            fsc = fsc/(2-fsc) # to FSChalf
+    else:
+        fsc, varn = numpy.ones(len(counts)), numpy.zeros(len(counts))
+
+    w_nomodel = numpy.ones(len(counts)) if no_fsc_weights else fsc
+    mean_fo = utils.hkl.binned_sum(FP, offsets) / counts
+    sig_fo = numpy.sqrt(utils.hkl.binned_sum(numpy.abs(FP)**2, offsets) / counts - numpy.abs(mean_fo)**2)
+
+    if has_fc:
+        D = hkldata.binned_df.D.to_numpy()
+        S = hkldata.binned_df.S.to_numpy() # variance of unexplained signal
+        w = numpy.ones(len(counts)) if no_fsc_weights or not has_halfmaps else S/(S+varn)
+        DFc = hkldata.df.FC.to_numpy()[order] # reordered copy; scaled in place
+        DFc *= numpy.repeat(D, counts)
+        delfwt = numpy.subtract(FP, DFc)
+        delfwt *= numpy.repeat(w, counts)
+        fup = delfwt * 2 # 2*w*FP + (1-2*w)*DFc = <F> + delfwt
+        fup += DFc
+        if has_halfmaps: # no point making this map when half maps not given
+            tmp["DELFWT_noscale"] = delfwt
+            tmp["Fupdate_noscale"] = fup
+
+    # maps below are calculated only up to the first bin with fsc <= 0
+    n_bins_ok = int(numpy.argmax(fsc <= 0)) if numpy.any(fsc <= 0) else len(counts)
+    n_ok = offsets[n_bins_ok]
+    rep = lambda x: numpy.repeat(x[:n_bins_ok], counts[:n_bins_ok])
+    Fo = FP[:n_ok]
+    s2 = s2[:n_ok]
+    if has_fc:
+        delfwt, fup, DFc = delfwt[:n_ok], fup[:n_ok], DFc[:n_ok]
+
+    if sharpening_b is None:
+        k = rep(sig_fo[:n_bins_ok] * numpy.sqrt(fsc[:n_bins_ok]))
+        if has_fc: # to avoid zero-division. if S=0 then w=0.
+            k_fofc = rep(numpy.where(S > 0, numpy.sqrt(S), 1.))
+    else:
+        k = k_fofc = numpy.exp(-sharpening_b*s2/4)
 
+    lab_suf = "" if B is None else "_b0"
+    if has_halfmaps:
+        numpy.multiply(Fo, rep(w_nomodel) / k, out=tmp["FWT"+lab_suf][:n_ok])
         if has_fc:
-            Fc = hkldata.df.FC.to_numpy()[idxes]
-            D = hkldata.binned_df.D[i_bin]
-            S = hkldata.binned_df.S[i_bin] # variance of unexplained signal
-            w = 1. if no_fsc_weights or not has_halfmaps else S/(S+varn)
-            delfwt = w * (Fo-D*Fc)
-            fup = 2 * w * Fo + (1 - 2*w) * D*Fc # <F> + delfwt
-            if has_halfmaps: # no point making this map when half maps not given
-                tmp["DELFWT_noscale"][idxes] = delfwt
-                tmp["Fupdate_noscale"][idxes] = fup
-
-        if not fsc_became_negative and fsc <= 0:
-            logger.writeln(" WARNING: cutting resolution at {:.2f} A because fsc < 0".format(hkldata.binned_df.d_max[i_bin]))
-            fsc_became_negative = True
-        if fsc_became_negative:
-            continue
-
-        if sharpening_b is None:
-            k = sig_fo * numpy.sqrt(fsc)
-            k_fofc = numpy.sqrt(S) if has_fc and S > 0 else 1. # to avoid zero-division. if S=0 then w=0.
-        else:
-            k = k_fofc = numpy.exp(-sharpening_b*s2_bin/4)
-            
-        lab_suf = "" if B is None else "_b0"
-        if has_halfmaps:
-            tmp["FWT"+lab_suf][idxes] = w_nomodel / k * Fo
-            if has_fc:
-                tmp["DELFWT"+lab_suf][idxes] = delfwt / k_fofc
-                tmp["Fupdate"+lab_suf][idxes] = fup / k
-        elif has_fc:
-            tmp["DELFWT"+lab_suf][idxes] = delfwt
-
-        if B is not None and has_halfmaps: # local B based map
-            k_l = numpy.exp(-B*s2_bin/4.)
-            k2_l = numpy.exp(-B*s2_bin/2.)
-            fsc_l = k2_l*fsc/(1+(k2_l-1)*fsc)
-            w_nomodel = 1. if no_fsc_weights else fsc_l
-            tmp["FWT"][idxes] = Fo*w_nomodel/k/k_l
-            if has_fc:
-                S_l = S * k2_l
-                w = 1. if no_fsc_weights or not has_halfmaps else S_l/(S_l+varn)            
-                delfwt = (Fo-D*Fc)*w/k_fofc/k_l
-                fup = (w*Fo+(1.-w)*D*Fc)/k/k_l
-                logger.writeln("{:4d} {:.4e} {:.4e} {:.4e} {:.4e} {:.4e} {:.4e}".format(i_bin,
-                                                                                      numpy.average(k),
-                                                                                      numpy.average(sig_fo),
-                                                                                      numpy.average(fsc_l),
-                                                                                      numpy.average(k_l),
-                                                                                      numpy.average(abs(fup)),
-                                                                                      numpy.average(abs(delfwt))))
-                tmp["DELFWT"][idxes] = delfwt
-                tmp["Fupdate"][idxes] = fup
+            numpy.divide(delfwt, k_fofc, out=tmp["DELFWT"+lab_suf][:n_ok])
+            numpy.divide(fup, k, out=tmp["Fupdate"+lab_suf][:n_ok])
+    elif has_fc:
+        tmp["DELFWT"+lab_suf][:n_ok] = delfwt
+
+    if B is not None and has_halfmaps: # local B based map
+        k_l = numpy.exp(-B*s2/4.)
+        k2_l = k_l * k_l # = exp(-B*s2/2)
+        fsc_r = rep(fsc)
+        fsc_l = k2_l*fsc_r/(1+(k2_l-1)*fsc_r)
+        w_nomodel = 1. if no_fsc_weights else fsc_l
+        numpy.multiply(Fo, w_nomodel/(k*k_l), out=tmp["FWT"][:n_ok])
+        if has_fc:
+            S_l = rep(S) * k2_l
+            w = 1. if no_fsc_weights or not has_halfmaps else S_l/(S_l+rep(varn))
+            delfwt = numpy.subtract(Fo, DFc)
+            delfwt *= w
+            fup = delfwt + DFc # w*Fo+(1-w)*DFc
+            fup /= k*k_l
+            delfwt /= k_fofc*k_l
+            offsets_b = offsets[:n_bins_ok+1]
+            mean_b = lambda x: utils.hkl.binned_sum(x, offsets_b) / counts[:n_bins_ok]
+            for i, stats in enumerate(zip(mean_b(k), sig_fo, mean_b(fsc_l), mean_b(k_l),
+                                          mean_b(numpy.abs(fup)), mean_b(numpy.abs(delfwt)))):
+                logger.writeln("{:4d} {:.4e} {:.4e} {:.4e} {:.4e} {:.4e} {:.4e}".format(hkldata.binned()[i][0], *stats))
+            tmp["DELFWT"][:n_ok] = delfwt
+            tmp["Fupdate"][:n_ok] = fup
+
+    if n_bins_ok < len(counts):
+        logger.writeln(" WARNING: cutting resolution at {:.2f} A because fsc < 0".format(hkldata.binned_df.d_max.iloc[n_bins_ok]))
 
     for l in labs:
-        hkldata.df[l] = tmp[l]
+        vals = numpy.zeros(len(hkldata.df.index), numpy.complex64)
+        vals[order] = tmp[l]
+        hkldata.df[l] = vals
 
     logger.writeln(" finished in {:.3f} sec.".format(time.time()-time_t))
     return labs
@@ -300,22 +330,23 @@ def write_files(hkldata, map_labs, grid_start, stats_str,
         
     if normalize_map and mask is not None:
         cutoff = 0.5
+        mask_sel = mask.array > cutoff # shared by Fo-Fc and Fo maps
         if "DELFWT" in hkldata.df:
             logger.writeln("Normalized Fo-Fc map requested.")
             delfwt_map = hkldata.fft_map("DELFWT", grid_size=mask.shape)
-            masked = delfwt_map.array[mask.array>cutoff]
+            n_masked, masked_mean, masked_std = utils.maps.mean_std_in_mask(delfwt_map.array, mask_sel)
             logger.writeln("   Whole volume: {} voxels".format(delfwt_map.point_count))
-            logger.writeln("  Masked volume: {} voxels (>{})".format(masked.size, cutoff))
+            logger.writeln("  Masked volume: {} voxels (>{})".format(n_masked, cutoff))
             global_mean = numpy.average(delfwt_map)
             global_std = numpy.std(delfwt_map)
             logger.writeln("    Global mean: {:.3e}".format(global_mean))
             logger.writeln("     Global std: {:.3e}".format(global_std))
-            masked_mean = numpy.average(masked)
-            masked_std = numpy.std(masked)
             logger.writeln("    Masked mean: {:.3e}".format(masked_mean))
             logger.writeln("     Masked std: {:.3e}".format(masked_std))
             #logger.writeln(" If you want to scale manually: {}".format())
-            scaled = (delfwt_map - masked_mean)/masked_std
+            scaled = delfwt_map.array # scale in place
+            scaled -= masked_mean
+            scaled /= masked_std
             hkldata.df["DELFWT"] /= masked_std # it would work if masked_mean~0
             if omit_h_electron:
                 scaled *= -1
@@ -329,10 +360,10 @@ def write_files(hkldata, map_labs, grid_start, stats_str,
         # Write Fo map as well
         if "FWT" in hkldata.df:
             fwt_map = hkldata.fft_map("FWT", grid_size=mask.shape)
-            masked = fwt_map.array[mask.array>cutoff]
-            masked_mean = numpy.average(masked)
-            masked_std = numpy.std(masked)
-            scaled = (fwt_map - masked_mean)/masked_std # does not make much sense for Fo map though
+            _, masked_mean, masked_std = utils.maps.mean_std_in_mask(fwt_map.array, mask_sel)
+            scaled = fwt_map.array # does not make much sense for Fo map though
+            scaled -= masked_mean
+            scaled /= masked_std
             hkldata.df["FWT"] /= masked_std # it would work if masked_mean~0
             filename = "{}_normalized_fo.mrc".format(output_prefix)
             logger.writeln("  Writing {}".format(filename))
@@ -8,6 +8,8 @@ Mozilla Public License, version 2.0; see LICENSE.
 from __future__ import absolute_import, division, print_function, generators
 import numpy
 import numpy.lib.recfunctions
+import itertools
+import weakref
 import scipy.optimize
 import pandas
 import gemmi
@@ -27,21 +29,65 @@ def correlation(obs, calc):
         return numpy.nan
     return numpy.corrcoef(obs[sel], calc[sel])[0,1]
 
+def binned_sum(x, offsets):
+    # sums of x[...,offsets[i]:offsets[i+1]]; x should be ordered by HklData.binned_order()
+    ret = numpy.zeros(x.shape[:-1] + (len(offsets)-1,), dtype=x.dtype)
+    sel = offsets[1:] > offsets[:-1] # reduceat does not work for empty bins
+    if numpy.any(sel):
+        ret[...,sel] = numpy.add.reduceat(x, offsets[:-1][sel], axis=-1)
+    return ret
+# binned_sum()
+
+def binned_moments(f1, f2, offsets):
+    # first and second moments of two complex arrays in each bin, all from one numpy.add.reduceat
+    tmp = numpy.empty((7, len(f1)))
+    tmp[0], tmp[1] = f1.real, f1.imag
+    tmp[2], tmp[3] = f2.real, f2.imag
+    numpy.multiply(tmp[0], tmp[0], out=tmp[4])
+    tmp[4] += tmp[1]**2
+    numpy.multiply(tmp[2], tmp[2], out=tmp[5])
+    tmp[5] += tmp[3]**2
+    numpy.multiply(tmp[0], tmp[2], out=tmp[6])
+    tmp[6] += tmp[1] * tmp[3]
+    n = numpy.diff(offsets)
+    sums = binned_sum(tmp, offsets) / n
+    return dict(n=n,
+                mean1=sums[0] + 1j * sums[1],
+                mean2=sums[2] + 1j * sums[3],
+                mean11=sums[4], # <|f1|^2>
+                mean22=sums[5], # <|f2|^2>
+                mean12=sums[6]) # <Re(f1 * conj(f2))>
+# binned_moments()
+
+def binned_fsc(f1, f2, offsets=None, moments=None):
+    # correlation of complex values (as numpy.real(numpy.corrcoef(f1, f2)[1,0])) in each bin
+    if moments is None:
+        moments = binned_moments(f1, f2, offsets)
+    m1, m2 = moments["mean1"], moments["mean2"]
+    cov = moments["mean12"] - numpy.real(m1 * numpy.conj(m2))
+    var1 = moments["mean11"] - numpy.abs(m1)**2
+    var2 = moments["mean22"] - numpy.abs(m2)**2
+    return cov / numpy.sqrt(var1 * var2)
+# binned_fsc()
+
+def hkl_columns(miller_array):
+    # dict of H, K, L columns; build DataFrame from a dict at once rather than adding columns one by one
+    miller_array = numpy.asarray(miller_array)
+    return {x: miller_array[:,i] for i, x in enumerate("HKL")}
+
 def df_from_asu_data(asu_data, label):
-    df = pandas.DataFrame(data=asu_data.miller_array,
-                          columns=["H","K","L"])
+    data = hkl_columns(asu_data.miller_array)
     if asu_data.value_array.dtype.names == ('value', 'sigma'):
-        df[label] = to64(asu_data.value_array["value"])
-        df["SIG"+label] = to64(asu_data.value_array["sigma"])
+        data[label] = to64(asu_data.value_array["value"])
+        data["SIG"+label] = to64(asu_data.value_array["sigma"])
     else:
-        df[label] = to64(asu_data.value_array)
-    return df
+        data[label] = to64(asu_data.value_array)
+    return pandas.DataFrame(data)
 
 def df_from_raw(miller_array, value_array, label):
-    df = pandas.DataFrame(data=miller_array,
-                          columns=["H","K","L"])
-    df[label] = to64(value_array)
-    return df
+    data = hkl_columns(miller_array)
+    data[label] = to64(value_array)
+    return pandas.DataFrame(data)
 
 def hkldata_from_asu_data(asu_data, label):
     df = df_from_asu_data(asu_data, label)
@@ -106,8 +152,8 @@ def hkldata_from_mtz(mtz, labels, newlabels=None, require_types=None):
             if newlabels[i] == "": # means this is phase and should be transferred to previous column
                 assert col_types.get(labels[i]) == "P"
                 assert col_types.get(labels[i-1]) == "F"
-                ph = numpy.deg2rad(df[labels[i]])
-                df[labels[i-1]] = df[labels[i-1]] * (numpy.cos(ph) + 1j * numpy.sin(ph))
+                ph = numpy.deg2rad(df[labels[i]].to_numpy())
+                df[labels[i-1]] = df[labels[i-1]].to_numpy() * numpy.exp(1j * ph)
                 del df[labels[i]]
         
         df.rename(columns={x:y for x,y in zip(labels, newlabels) if y != ""}, inplace=True)
@@ -125,14 +171,13 @@ def blur_mtz(mtz, B):
     # modify given mtz object
     
     s2 = mtz.make_1_d2_array()
-    k2 = numpy.exp(-B*s2/2)
     k = numpy.exp(-B*s2/4)
+    k2 = k * k # = exp(-B*s2/2)
     i_labs = [c.label for c in mtz.columns if c.type in "JK"]
     f_labs = [c.label for c in mtz.columns if c.type in "FDG"]
+    all_labs = set(mtz.column_labels())
     for labs in i_labs, f_labs:
-        for l in labs:
-            sl = "SIG"+l
-            if sl in mtz.column_labels(): labs.append(sl)
+        labs.extend(["SIG"+l for l in labs if "SIG"+l in all_labs])
 
     if i_labs:
         logger.writeln("Intensities: {}".format(" ".join(i_labs)))
@@ -176,8 +221,10 @@ def mtz_selected(mtz, columns):
         mtz2.add_column(col, col_dict[col].type,
                         dataset_id=col_dict[col].dataset_id, expand_data=False)
 
-    idxes = [col_idxes[col] for col in columns]
-    data = numpy.array(mtz, copy=False)[:, idxes]
+    # column by column; column-major buffer so that each copy is contiguous
+    data = numpy.empty((mtz.nreflections, len(columns)), dtype=numpy.float32, order="F")
+    for i, col in enumerate(columns):
+        data[:,i] = col_dict[col].array
     mtz2.set_data(data)
     return mtz2
 # mtz_selected()
@@ -215,6 +262,8 @@ class HklData:
         self.df = df
         self.binned_df = binned_df
         self._bin_and_indices = []
+        self._d_checked = None # weakref to the df whose d column has been validated
+        self._hkl_cache = None # (weakref to df, int32 HKL array)
     # __init__()
 
     def update_cell(self, cell):
@@ -224,12 +273,13 @@ class HklData:
     def switch_to_asu(self):
         # Need to care phases
         assert not any(numpy.iscomplexobj(self.df[x]) for x in self.df)
-        hkl = self.miller_array().to_numpy()
+        hkl = self.miller_array_np().copy()
         self.sg.switch_to_asu(hkl)
-        self.df[["H","K","L"]] = hkl
-        # in some environment type changes to int64 even though hkl's dtype is int32
-        # it causes a problem in self.debye_waller_factors()
-        self.df = self.df.astype({x: numpy.int32 for x in "HKL"})
+        # replace each column by an int32 array; assigning to df[["H","K","L"]] could turn them into int64
+        # in some environment, which causes a problem in self.debye_waller_factors()
+        for i, lab in enumerate("HKL"):
+            self.df[lab] = hkl[:,i]
+        self._hkl_cache = (weakref.ref(self.df), hkl)
 
     def copy(self, d_min=None, d_max=None):
         # FIXME we should reset_index here? after resolution truncation, max(df.index) will be larger than size.
@@ -268,8 +318,16 @@ class HklData:
     def miller_array(self):
         return self.df[["H","K","L"]]
 
+    def miller_array_np(self):
+        # contiguous int32 (N, 3) array of HKL, reused until self.df is replaced or sorted. do not modify.
+        if self._hkl_cache is None or self._hkl_cache[0]() is not self.df:
+            hkl = numpy.ascontiguousarray(self.df[["H","K","L"]].to_numpy(numpy.int32))
+            self._hkl_cache = (weakref.ref(self.df), hkl)
+        return self._hkl_cache[1]
+    # miller_array_np()
+
     def s_array(self):
-        hkl = self.miller_array()
+        hkl = self.miller_array_np()
         return numpy.dot(hkl, self.cell.fractionalization_matrix)
 
     def ssq_mat(self):
@@ -279,9 +337,12 @@ class HklData:
         # x[None,:].T <= (N, 6, 1)
         # x.T[:,None] <= (N, 1, 6)    they can be matmul'ed.
         svecs = self.s_array()
-        tmp = (0.25 * svecs[:,0]**2, 0.25 * svecs[:,1]**2, 0.25 * svecs[:,2]**2,
-               0.5 * svecs[:,0] * svecs[:,1], 0.5 * svecs[:,0] * svecs[:,2], 0.5 * svecs[:,1] * svecs[:,2])
-        return numpy.array(tmp)
+        ret = numpy.empty((6, svecs.shape[0]))
+        for i, (j, k, f) in enumerate(((0, 0, 0.25), (1, 1, 0.25), (2, 2, 0.25),
+                                       (0, 1, 0.5), (0, 2, 0.5), (1, 2, 0.5))):
+            numpy.multiply(svecs[:,j], svecs[:,k], out=ret[i])
+            ret[i] *= f
+        return ret
     # aniso_s_u_s_as_left_mat()
     
     def debye_waller_factors(self, b_cart=None, b_iso=None):
@@ -290,29 +351,34 @@ class HklData:
             return numpy.exp(-b_iso / 4 * s2)
         if b_cart is not None:
             b_star = b_cart.transformed_by(self.cell.fractionalization_matrix)
-            return numpy.exp(-b_star.r_u_r(self.miller_array().to_numpy()) / 4)
+            return numpy.exp(-b_star.r_u_r(self.miller_array_np()) / 4)
     
     def calc_d(self):
-        self.df["d"] = self.cell.calculate_d_array(self.miller_array())
+        self.df["d"] = self.cell.calculate_d_array(self.miller_array_np())
+        self._d_checked = weakref.ref(self.df)
     # calc_d()
 
     def calc_epsilon(self):
-        self.df["epsilon"] = self.sg.operations().epsilon_factor_without_centering_array(self.miller_array())
+        self.df["epsilon"] = self.sg.operations().epsilon_factor_without_centering_array(self.miller_array_np())
     # calc_epsilon()
 
     def calc_centric(self):
-        self.df["centric"] = self.sg.operations().centric_flag_array(self.miller_array()).astype(int)
+        self.df["centric"] = self.sg.operations().centric_flag_array(self.miller_array_np()).astype(int)
     # calc_centric()
         
     def d_spacings(self):
-        if "d" not in self.df or self.df.d.isnull().values.any():
-            self.calc_d()
+        # full scan for missing d only when self.df has been replaced since the last check
+        if self._d_checked is None or self._d_checked() is not self.df or "d" not in self.df:
+            if "d" not in self.df or self.df.d.isnull().values.any():
+                self.calc_d()
+            self._d_checked = weakref.ref(self.df)
         return self.df.d
     # calc_d()
 
     def sort_by_resolution(self, ascending=False):
         self.d_spacings()
         self.df.sort_values("d", ascending=ascending, inplace=True)
+        self._hkl_cache = None # rows reordered in place
     # sort_by_resolution()
 
     def d_min_max(self, labs=None):
@@ -326,16 +392,33 @@ class HklData:
         # make complete set
         d_min, d_max = self.d_min_max()
         all_hkl = gemmi.make_miller_array(self.cell, self.sg, d_min, d_max)
-        match = gemmi.HklMatch(self.miller_array(), all_hkl)
-        missing_hkl_df = pandas.DataFrame(all_hkl[numpy.asarray(match.pos) < 0], columns=["H","K","L"])
-        self.df = pandas.concat([self.df, missing_hkl_df])
-        logger.writeln("Completing hkldata: {} reflections were missing".format(len(missing_hkl_df.index)))
+        match = gemmi.HklMatch(self.miller_array_np(), all_hkl)
+        missing_hkl = all_hkl[numpy.asarray(match.pos) < 0]
+        # build each column once at full length; missing rows get NaN (same dtype promotion as pandas.concat)
+        hkl_all = hkl_columns(numpy.concatenate([self.miller_array_np(), missing_hkl]))
+        n_all = len(hkl_all["H"])
+        data = {}
+        for lab in self.df.columns:
+            if lab in hkl_all:
+                data[lab] = hkl_all[lab]
+            else:
+                data[lab] = pandas.Series(self.df[lab].array).reindex(range(n_all))
+        self.df = pandas.DataFrame(data)
+        logger.writeln("Completing hkldata: {} reflections were missing".format(len(missing_hkl)))
         self.calc_d()
     # complete()
 
+    def all_present(self, labels):
+        # True for rows where none of labels is missing; column by column without an (N, ncols) bool frame
+        sel = numpy.ones(len(self.df.index), dtype=bool)
+        for lab in labels:
+            sel &= self.df[lab].notna().to_numpy()
+        return sel
+    # all_present()
+
     def completeness(self, label=None):
         if label is None:
-            n_missing = numpy.sum(self.df.isna().any(axis=1))
+            n_missing = len(self.df.index) - numpy.sum(self.all_present(self.df.columns))
         else:
             n_missing = numpy.sum(self.df[label].isna())
         n_all = len(self.df.index)
@@ -350,15 +433,18 @@ class HklData:
         self._bin_and_indices = []
         d_limits = 1 / numpy.sqrt(binner.limits)
         bin_number = binner.get_bins_from_1_d2(s2)
+        # one stable sort instead of scanning bin_number for each bin
+        order = numpy.argsort(bin_number, kind="stable")
+        bounds = numpy.searchsorted(bin_number[order], numpy.arange(binner.size+1))
+        d_max, d_min = self.d_min_max()[::-1]
         d_max_all = []
         d_min_all = []
         for i in range(binner.size):
-            left = numpy.max(self.d_spacings()) if i == 0 else d_limits[i-1]
-            right = numpy.min(self.d_spacings()) if i == binner.size -1 else d_limits[i]
-            sel = numpy.where(bin_number==i)[0] # slow?
+            left = d_max if i == 0 else d_limits[i-1]
+            right = d_min if i == binner.size -1 else d_limits[i]
             d_max_all.append(left)
             d_min_all.append(right)
-            self._bin_and_indices.append((i, sel))
+            self._bin_and_indices.append((i, order[bounds[i]:bounds[i+1]]))
 
         self.df["bin"] = bin_number
         self.binned_df = pandas.DataFrame(dict(d_max=d_max_all, d_min=d_min_all), index=list(range(binner.size)))
@@ -370,30 +456,27 @@ class HklData:
             self.sort_by_resolution()
         self.df.reset_index(drop=True, inplace=True) # to allow numpy.array indexing
             
-        self.df["bin"] = (max_edge/self.d_spacings()+0.5).astype(int)
+        bin_number = (max_edge/self.d_spacings().to_numpy()+0.5).astype(int)
         # Merge inner/outer shells if too few # TODO smarter way
-        bin_counts = []
-        bin_ranges = {}
+        # bin numbers are small non-negative integers, so histogram directly instead of sorting
+        counts = numpy.bincount(bin_number)
+        bins = numpy.nonzero(counts)[0]
+        counts = counts[bins]
+        sel = bins != 0 # ignore DC component
+        bins, counts = bins[sel].tolist(), counts[sel].tolist()
         modify_table = {}
-        for i_bin, g in self.df.groupby("bin", sort=True):
-            if i_bin == 0: continue # ignore DC component
-            bin_counts.append([i_bin, g.index])
-            bin_ranges[i_bin] = (numpy.max(g.d), numpy.min(g.d))
-
-        for i in range(len(bin_counts)):
-            if len(bin_counts[i][1]) < 10 and i < len(bin_counts)-1:
-                bin_counts[i+1][1] = bin_counts[i+1][1].union(bin_counts[i][1])
-                modify_table[bin_counts[i][0]] = bin_counts[i+1][0]
-                logger.writeln("Bin {} only has {} data. Merging with next bin.".format(bin_counts[i][0],
-                                                                                      len(bin_counts[i][1])))
+        for i in range(len(bins)):
+            if counts[i] < 10 and i < len(bins)-1:
+                counts[i+1] += counts[i]
+                modify_table[bins[i]] = bins[i+1]
+                logger.writeln("Bin {} only has {} data. Merging with next bin.".format(bins[i], counts[i]))
             else: break
 
-        for i in reversed(range(len(bin_counts))):
-            if i > 0 and len(bin_counts[i][1])/len(bin_counts[i-1][1]) < 0.5:
-                bin_counts[i-1][1] = bin_counts[i-1][1].union(bin_counts[i][1])
-                modify_table[bin_counts[i][0]] = bin_counts[i-1][0]
-                logger.writeln("Bin {} only has {} data. Merging with previous bin.".format(bin_counts[i][0],
-                                                                                          len(bin_counts[i][1])))
+        for i in reversed(range(len(bins))):
+            if i > 0 and counts[i]/counts[i-1] < 0.5:
+                counts[i-1] += counts[i]
+                modify_table[bins[i]] = bins[i-1]
+                logger.writeln("Bin {} only has {} data. Merging with previous bin.".format(bins[i], counts[i]))
             else: break
 
         while True:
@@ -404,39 +487,46 @@ class HklData:
                     flag = False
             if flag: break
 
+        # relabel merged bins in one pass
+        remap = numpy.arange(numpy.max(bin_number)+1)
         for i_bin in modify_table:
-            new_bin = modify_table[i_bin]
-            self.df["bin"] = numpy.where(self.df["bin"].to_numpy() == i_bin, new_bin, self.df["bin"].to_numpy())
-            bin_ranges[new_bin] = (max(bin_ranges[i_bin][0], bin_ranges[new_bin][0]),
-                                   min(bin_ranges[i_bin][1], bin_ranges[new_bin][1]))
+            remap[i_bin] = modify_table[i_bin]
+        bin_number = remap[bin_number]
+        self.df["bin"] = bin_number
 
-        self._bin_and_indices = []
-        bin_all = []
-        d_max_all = []
-        d_min_all = []
-        for i_bin, indices in bin_counts:
-            if i_bin in modify_table: continue
-            #if sort: # want this, but we cannot take len() for slice. we can add ncoeffs to binned_df
-            #    self._bin_and_indices.append((i_bin, slice(numpy.min(indices), numpy.max(indices))))
-            #else:
-            self._bin_and_indices.append((i_bin, indices))
-                
-            bin_all.append(i_bin)
-            d_max_all.append(bin_ranges[i_bin][0])
-            d_min_all.append(bin_ranges[i_bin][1])
-        self.binned_df = pandas.DataFrame(dict(d_max=d_max_all, d_min=d_min_all), index=bin_all)
+        # indices and resolution ranges of final bins from one sort
+        order = numpy.argsort(bin_number, kind="stable")
+        counts = numpy.bincount(bin_number)
+        bin_all = numpy.nonzero(counts)[0]
+        counts = counts[bin_all]
+        starts = numpy.cumsum(counts) - counts
+        d = self.d_spacings().to_numpy()[order]
+        d_max_all = numpy.maximum.reduceat(d, starts)
+        d_min_all = numpy.minimum.reduceat(d, starts)
+        sel = bin_all != 0
+        self._bin_and_indices = [(i_bin, order[i:i+n]) for i_bin, i, n in zip(bin_all[sel], starts[sel], counts[sel])]
+        self.binned_df = pandas.DataFrame(dict(d_max=d_max_all[sel], d_min=d_min_all[sel]), index=bin_all[sel])
     # setup_relion_binning()
 
     def binned_data_as_array(self, lab):
+        # binned_df rows are in the order of binned(); reflections not in any bin get zero
         vals = numpy.zeros(len(self.df.index), dtype=self.binned_df[lab].dtype)
-        for i_bin, idxes in self.binned():
-            vals[idxes] = self.binned_df[lab][i_bin]
+        order, offsets = self.binned_order()
+        vals[order] = numpy.repeat(self.binned_df[lab].to_numpy(), numpy.diff(offsets))
         return vals
     # binned_data_as_array()
 
     def binned(self):
         return self._bin_and_indices
 
+    def binned_order(self):
+        # permutation that makes reflections of each bin contiguous (in the order of binned())
+        # and offsets so that bin i is order[offsets[i]:offsets[i+1]]
+        order = numpy.concatenate([idxes for _, idxes in self.binned()])
+        offsets = numpy.cumsum([0] + [len(idxes) for _, idxes in self.binned()])
+        return order, offsets
+    # binned_order()
+
     def columns(self):
         return [x for x in self.df.columns if x not in "HKL"]
     
@@ -479,9 +569,10 @@ class HklData:
     # guess_free_number()        
 
     def as_numpy_arrays(self, labels, omit_nan=True):
-        tmp = self.df[labels]
-        if omit_nan: tmp = tmp[~tmp.isna().any(axis=1)]
-        return [tmp[lab].to_numpy() for lab in labels]
+        if not omit_nan:
+            return [self.df[lab].to_numpy() for lab in labels]
+        sel = self.all_present(labels)
+        return [self.df[lab].array[sel].to_numpy() for lab in labels]
     # as_numpy_arrays()
 
     def remove_nonpositive(self, label):
@@ -493,7 +584,7 @@ class HklData:
     # remove_nonpositive()
 
     def remove_systematic_absences(self):
-        is_absent = self.sg.operations().systematic_absences(self.miller_array())
+        is_absent = self.sg.operations().systematic_absences(self.miller_array_np())
         n_absent = numpy.sum(is_absent)
         if n_absent > 0:
             logger.writeln("Removing {} systematic absences".format(n_absent))
@@ -530,21 +621,20 @@ class HklData:
             asutype = gemmi.FloatAsuData
         
         return asutype(self.cell, self.sg,
-                       self.miller_array(), data)
+                       self.miller_array_np(), data)
     # as_asu_data()
 
     def fft_map(self, label=None, data=None, grid_size=None, sample_rate=3):
         if data is None:
             data = self.df[label]
-        return fft_map(self.cell, self.sg, self.miller_array(), data, grid_size, sample_rate)
+        return fft_map(self.cell, self.sg, self.miller_array_np(), data, grid_size, sample_rate)
     # fft_map()
 
     def d_eff(self, label):
         # Effective resolution defined using FSC
-        fsc = self.binned_df[label]
-        a = 0.
-        for i_bin, idxes in self.binned():
-            a += len(idxes) * fsc[i_bin]
+        bins = [i_bin for i_bin, _ in self.binned()]
+        counts = numpy.array([len(idxes) for _, idxes in self.binned()])
+        a = numpy.dot(counts, self.binned_df[label].loc[bins].to_numpy())
 
         fac = (a/len(self.df.index))**(1/3.)
         d_min = self.d_min_max()[0]
@@ -553,9 +643,14 @@ class HklData:
     # d_eff()
 
     def hard_sphere_kernel(self, r_ang, grid_size):
-        s = 1. / self.d_spacings()
+        s = 1. / self.d_spacings().to_numpy()
         t = 2 * numpy.pi * s * r_ang
-        F_kernel = 3. * (-t * numpy.cos(t) + numpy.sin(t)) / t**3
+        t2 = t**2
+        small = t < 0.1 # Taylor expansion where the closed form loses precision
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            F_kernel = numpy.where(small, 1 - t2/10 + t2**2/280,
+                                   3. * (numpy.sin(t) - t * numpy.cos(t)) / (t2 * t))
+        F_kernel[t == 0] = 0 # F000 is added below
         knl = self.fft_map(data=F_kernel, grid_size=grid_size)
         knl.array[:] += 1. / knl.unit_cell.volume # F000
         knl.array[:] /= numpy.sum(knl.array)
@@ -577,12 +672,13 @@ class HklData:
         # 1st step: minimize (log(|f1|)-log(|f2|*e^k*e^(-b*s2/4)))^2 starting with k=1, b=0.
         tmp = numpy.log(f2p) - numpy.log(f1p)
         # g = [dT/dk, dT/db]
-        g = numpy.array([2 * numpy.sum(tmp), -numpy.sum(tmp*s2p)/2])
+        # sums of products as dot products to avoid temporaries
+        g = numpy.array([2 * numpy.sum(tmp), -numpy.dot(tmp, s2p)/2])
         H = numpy.zeros((2,2))
         H[0,0] = 2*len(f1p)
-        H[1,1] = numpy.sum(s2p**2/8)
+        H[1,1] = numpy.dot(s2p, s2p)/8
         H[0,1] = H[1,0] = -numpy.sum(s2p)/2
-        x = -numpy.dot(numpy.linalg.inv(H), g)
+        x = numpy.linalg.solve(H, -g)
         k1 = numpy.exp(x[0])
         B1 = x[1]
         logger.writeln(" initial estimate using log: k= {:.2e} B= {:.2e}".format(k1, B1))
@@ -592,24 +688,37 @@ class HklData:
         logger.writeln(" R= {:.4f} (was: {:.4f})".format(r_step1, r_step0))
 
         # 2nd step: - minimize (|f1|-|f2|*k*e^(-b*s2/4))^2 iteratively (TODO with regularisation)
+        sel_valid = ~numpy.logical_or(numpy.isnan(f1), numpy.isnan(f2))
+        f1v, f2v, s2v = f1[sel_valid], f2[sel_valid], s2[sel_valid]
+        f2t_cache = {} # |f2|*e^(-b*s2/4) for the last x; minimize() asks for f, grad and hess at the same x
+
+        def calc_f2t(x):
+            key = (x[0], x[1])
+            if key not in f2t_cache:
+                f2t_cache.clear()
+                f2t_cache[key] = f2v * numpy.exp(-x[1]*s2v/4)
+            return f2t_cache[key]
+
+        def func2(x):
+            return numpy.sum((f1v-x[0]*calc_f2t(x))**2)
 
         def grad2(x):
-            t = numpy.exp(-x[1]*s2/4)
-            tmp = (f1-f2*x[0]*t)*f2*t
-            return numpy.array([-2.*numpy.nansum(tmp),
-                                0.5*x[0]*numpy.nansum(tmp*s2)])
+            f2t = calc_f2t(x)
+            tmp = (f1v-x[0]*f2t)*f2t
+            return numpy.array([-2.*numpy.sum(tmp),
+                                0.5*x[0]*numpy.sum(tmp*s2v)])
 
         def hess2(x):
             h = numpy.zeros((2, 2))
-            t = numpy.exp(-x[1]*s2/4)
-            t2 = t**2
-            h[0,0] = numpy.nansum(f2**2 * t2) * 2
-            h[1,1] = numpy.nansum(f2 * s2**2/4 * (-f1/2*t + f2*x[0]*t2)) * x[0]
-            h[1,0] = numpy.nansum(f2 * s2 * (f1/2*t - f2*x[0]*t2))
+            f2t = calc_f2t(x)
+            f2t2 = f2t**2
+            h[0,0] = numpy.sum(f2t2) * 2
+            h[1,1] = numpy.sum(s2v**2/4 * (-f1v/2*f2t + x[0]*f2t2)) * x[0]
+            h[1,0] = numpy.sum(s2v * (f1v/2*f2t - x[0]*f2t2))
             h[0,1] = h[1,0]
             return h
 
-        res = scipy.optimize.minimize(fun=lambda x: numpy.nansum((f1-f2*x[0]*numpy.exp(-x[1]*s2/4))**2),
+        res = scipy.optimize.minimize(fun=func2,
                                       jac=grad2,
                                       hess=hess2,
                                       method="Newton-CG",
@@ -653,8 +762,9 @@ class HklData:
     def translation_factor(self, shift):
         if type(shift) != gemmi.Position:
             shift = gemmi.Position(*shift)
-        return numpy.exp(2.j*numpy.pi*numpy.dot(self.miller_array(),
-                                                self.cell.fractionalize(shift).tolist()))
+        phase = numpy.dot(self.miller_array_np(), self.cell.fractionalize(shift).tolist())
+        phase *= 2 * numpy.pi
+        return numpy.exp(1.j * phase)
     # translation_factor()
     def translate(self, lab, shift):
         # apply phase shift
@@ -673,19 +783,28 @@ class HklData:
         else:
             df = self.df
             
-        ndata = sum(2 if numpy.iscomplexobj(df[lab]) else 1 for lab in labs)
+        is_complex = {lab: numpy.iscomplexobj(df[lab]) for lab in labs}
+        ndata = sum(2 if is_complex[lab] else 1 for lab in labs)
 
-        data = numpy.empty((len(df.index), ndata + 3), dtype=numpy.float32)
-        data[:,:3] = df[["H","K","L"]]
+        # column-major so that each column below is filled contiguously
+        data = numpy.empty((len(df.index), ndata + 3), dtype=numpy.float32, order="F")
+        for i, lab in enumerate("HKL"):
+            data[:,i] = df[lab].to_numpy()
         idx = 3
-        for lab in labs:
-            if numpy.iscomplexobj(df[lab]):
-                data[:,idx] = numpy.abs(df[lab])
-                data[:,idx+1] = numpy.angle(df[lab], deg=True)
-                idx += 2
+        for cplx, group in itertools.groupby(labs, key=is_complex.get):
+            group = list(group)
+            if cplx:
+                for lab in group:
+                    # write amplitude and phase directly into the output columns
+                    vals = df[lab].to_numpy()
+                    numpy.hypot(vals.real, vals.imag, out=data[:,idx])
+                    numpy.arctan2(vals.imag, vals.real, out=data[:,idx+1])
+                    numpy.degrees(data[:,idx+1], out=data[:,idx+1])
+                    idx += 2
             else:
-                data[:,idx] = df[lab].to_numpy(numpy.float32, na_value=numpy.nan) # for nullable integers
-                idx += 1
+                # consecutive real columns are converted as one block
+                data[:,idx:idx+len(group)] = df[group].to_numpy(numpy.float32, na_value=numpy.nan) # for nullable integers
+                idx += len(group)
 
         mtz = gemmi.Mtz()
         mtz.spacegroup = self.sg
@@ -694,7 +813,7 @@ class HklData:
         for label in ['H', 'K', 'L']: mtz.add_column(label, 'H')
 
         for lab in labs:
-            if numpy.iscomplexobj(df[lab]):
+            if is_complex[lab]:
                 mtz.add_column(lab, "F")
                 if phase_label_decorator is None:
                     plab = {"FWT": "PHWT", "DELFWT": "PHDELWT", "FAN":"PHAN"}.get(lab, "PH"+lab)
@@ -16,7 +16,11 @@ from servalcat.utils import hkl
 from servalcat import ext
 
 def new_grid_like(gr):
-    return type(gr)(gr.array*0, gr.unit_cell, gr.spacegroup)
+    # zero-filled grid; avoids creating (and then copying) a temporary gr.array*0
+    ret = type(gr)(*gr.shape)
+    ret.set_unit_cell(gr.unit_cell)
+    ret.spacegroup = gr.spacegroup
+    return ret
 # new_grid_like()
 
 def copy_maps(maps):
@@ -27,7 +31,7 @@ def mask_from_model(st, radius, soft_edge=0, grid=None, unit_cell=None, spacegro
     if grid is not None:
         mask = new_grid_like(grid)
     else:
-        mask = gemmi.FloatGrid(grid_shape)
+        mask = gemmi.FloatGrid(*grid_shape)
         mask.set_unit_cell(unit_cell)
         mask.spacegroup = spacegroup
 
@@ -80,6 +84,18 @@ def half2full(map_h1, map_h2):
     return gr
 # half2full()
 
+def mean_std_in_mask(array, sel):
+    # number, mean and std of array[sel], accumulated section by section to avoid a masked copy of whole array
+    n, s1, s2 = 0, 0., 0.
+    for a, m in zip(array, sel):
+        v = a[m].astype(numpy.float64)
+        n += v.size
+        s1 += numpy.sum(v)
+        s2 += numpy.dot(v, v)
+    mean = s1 / n
+    return n, mean, numpy.sqrt(max(0., s2 / n - mean**2))
+# mean_std_in_mask()
+
 def nyquist_resolution(map_grid):
     grid_shape = map_grid.shape
     rec_cell = map_grid.unit_cell.reciprocal().parameters
@@ -109,10 +125,13 @@ $GRAPHS: ln(Mn(|F|)) :A:1,2:
 : FSC(full) :A:1,4:
 $$ 1/resol^2 ln(Mn(|F|)) normalizer FSC $$
 $$""")
-        for i_bin, idxes in hkldata.binned():
-            bin_d_min = hkldata.binned_df.d_min[i_bin]
-            Fo = hkldata.df.FP.to_numpy()[idxes]
-            FSCfull = hkldata.binned_df.FSCfull[i_bin]
+        FP = hkldata.df.FP.to_numpy()
+        d_min_all = hkldata.binned_df.d_min.to_numpy()
+        fsc_full_all = hkldata.binned_df.FSCfull.to_numpy()
+        for i, (i_bin, idxes) in enumerate(hkldata.binned()):
+            bin_d_min = d_min_all[i]
+            Fo = FP[idxes]
+            FSCfull = fsc_full_all[i]
             sig_fo = numpy.std(Fo)
             if FSCfull > 0:
                 n_fo = sig_fo * numpy.sqrt(FSCfull)
@@ -120,7 +139,6 @@ $$""")
                 n_fo = sig_fo # XXX not a right way
                 
             normalizer[idxes] = n_fo
-            for lab in labs: hkldata.df.loc[idxes, lab] /= n_fo
             logger.writeln("{:.4f} {:.2f} {:.3f} {:.4f}".format(1/bin_d_min**2,
                                                               numpy.log(numpy.average(numpy.abs(Fo))),
                                                               n_fo, FSCfull))
@@ -130,7 +148,8 @@ $$""")
     else:
         logger.writeln("Sharpening B before masking= {}".format(b))
         normalizer[:] = hkldata.debye_waller_factors(b_iso=b)
-        for lab in labs: hkldata.df[lab] /= normalizer
+
+    for lab in labs: hkldata.df[lab] /= normalizer
 
     # 2. Mask, FFT, and unsharpen
     for lab in labs:
@@ -153,6 +172,9 @@ $$""")
 def mask_and_fft_maps(maps, d_min, mask=None, with_000=True):
     assert len(maps) <= 2
     hkldata = None
+    if mask is not None:
+        # convert once (no copy if mask is FloatGrid) so that maps are multiplied in place without casting
+        mask = numpy.asarray(mask, dtype=numpy.float32)
     for i, m in enumerate(maps):
         if len(maps) == 2:
             lab = "F_map{}".format(i+1)
@@ -160,7 +182,7 @@ def mask_and_fft_maps(maps, d_min, mask=None, with_000=True):
             lab = "FP"
         g = m[0]
         if mask is not None:
-            g.array[:] *= mask
+            numpy.multiply(g.array, mask, out=g.array)
         f_grid = gemmi.transform_map_to_f_phi(g)
         if hkldata is None:
             asudata = f_grid.prepare_asu_data(dmin=d_min, with_000=with_000)
@@ -175,30 +197,48 @@ def mask_and_fft_maps(maps, d_min, mask=None, with_000=True):
 # mask_and_fft_maps()
     
 def calc_noise_var_from_halfmaps(hkldata):
-    hkldata.binned_df["var_noise"] = 0.
-    hkldata.binned_df["var_signal"] = 0.
-    hkldata.binned_df["FSCfull"] = 0.
-    
+    n_bins = len(hkldata.binned())
+    var_noise = numpy.zeros(n_bins)
+    var_signal = numpy.zeros(n_bins)
+    fsc_full = numpy.zeros(n_bins)
+
+    # reorder once so that each bin is a contiguous slice
+    order, offsets = hkldata.binned_order()
+    F1 = hkldata.df.F_map1.to_numpy()[order]
+    F2 = hkldata.df.F_map2.to_numpy()[order]
+    # variances of (F1-F2)/2 and (F1+F2)/2 from the same per-bin sums as FSC
+    moments = hkl.binned_moments(F1, F2, offsets)
+    m1, m2 = moments["mean1"], moments["mean2"]
+    m11_22 = moments["mean11"] + moments["mean22"]
+    varn_all = (m11_22 - 2 * moments["mean12"] - numpy.abs(m1 - m2)**2) / 4
+    vart_all = (m11_22 + 2 * moments["mean12"] - numpy.abs(m1 + m2)**2) / 4
+    with numpy.errstate(divide="ignore", invalid="ignore"): # for bins with too few data
+        fsc_all = hkl.binned_fsc(F1, F2, moments=moments)
+    d_min_all = hkldata.binned_df.d_min.to_numpy()
+    d_max_all = hkldata.binned_df.d_max.to_numpy()
     logger.writeln("Bin Ncoeffs d_max   d_min   FSChalf var.noise")
-    for i_bin, idxes in hkldata.binned():
-        bin_d_min = hkldata.binned_df.d_min[i_bin]
-        bin_d_max = hkldata.binned_df.d_max[i_bin]
+    for i, (i_bin, _) in enumerate(hkldata.binned()):
+        bin_d_min = d_min_all[i]
+        bin_d_max = d_max_all[i]
         
-        sel1 = hkldata.df.F_map1.to_numpy()[idxes]
-        sel2 = hkldata.df.F_map2.to_numpy()[idxes]
+        n = moments["n"][i]
 
-        if sel1.size < 3:
-            logger.writeln("WARNING: skipping bin {} with size= {}".format(i_bin, sel1.size))
+        if n < 3:
+            logger.writeln("WARNING: skipping bin {} with size= {}".format(i_bin, n))
             continue
 
-        fsc = numpy.real(numpy.corrcoef(sel1, sel2)[1,0])
-        varn = numpy.var(sel1-sel2)/4
-        vart = numpy.var(sel1+sel2)/4
-        logger.writeln("{:3d} {:7d} {:7.3f} {:7.3f} {:.4f} {:e}".format(i_bin, sel1.size, bin_d_max, bin_d_min,
+        fsc = fsc_all[i]
+        varn = varn_all[i]
+        vart = vart_all[i]
+        logger.writeln("{:3d} {:7d} {:7.3f} {:7.3f} {:.4f} {:e}".format(i_bin, n, bin_d_max, bin_d_min,
                                                                       fsc, varn))
-        hkldata.binned_df.loc[i_bin, "var_noise"] = varn
-        hkldata.binned_df.loc[i_bin, "var_signal"] = vart-varn
-        hkldata.binned_df.loc[i_bin, "FSCfull"] = 2*fsc/(1+fsc)
+        var_noise[i] = varn
+        var_signal[i] = vart-varn
+        fsc_full[i] = 2*fsc/(1+fsc)
+
+    hkldata.binned_df["var_noise"] = var_noise
+    hkldata.binned_df["var_signal"] = var_signal
+    hkldata.binned_df["FSCfull"] = fsc_full
 # calc_noise_var_from_halfmaps()
 
 def write_ccp4_map(filename, array, cell=None, sg=None, mask_for_extent=None, mask_threshold=0.5, mask_padding=5,
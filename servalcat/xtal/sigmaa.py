@@ -922,6 +922,11 @@ def determine_ml_params(hkldata, use_int, fc_labs, D_labs, b_aniso, centric_and_
         # Refine b_aniso
         adpdirs = utils.model.adp_constraints(hkldata.sg.operations(), hkldata.cell, tr0=True)
         SMattolist = lambda B: [B.u11, B.u22, B.u33, B.u12, B.u13, B.u23]
+        # extract columns once; df[fc_labs].to_numpy() copies all Fc columns
+        Io, sigIo = hkldata.df.I.to_numpy(), hkldata.df.SIGI.to_numpy()
+        Fcs = hkldata.df[fc_labs].to_numpy()
+        centric_and_1 = hkldata.df.centric.to_numpy() + 1
+        epsilon = hkldata.df.epsilon.to_numpy()
 
         def target_ani(x):
             b = gemmi.SMat33d(*numpy.dot(x, adpdirs))
@@ -937,10 +942,10 @@ def determine_ml_params(hkldata, use_int, fc_labs, D_labs, b_aniso, centric_and_
             S2mat = hkldata.ssq_mat() # ssqmat
             g = numpy.zeros(6)
             for i_bin, idxes in hkldata.binned():
-                r = integr.ll_int_der1_ani(hkldata.df.I.to_numpy()[idxes], hkldata.df.SIGI.to_numpy()[idxes],
+                r = integr.ll_int_der1_ani(Io[idxes], sigIo[idxes],
                                            k_ani[idxes], hkldata.binned_df.loc[i_bin, "S"],
-                                           hkldata.df[fc_labs].to_numpy()[idxes], hkldata.binned_df.loc[i_bin, D_labs],
-                                           hkldata.df.centric.to_numpy()[idxes]+1, hkldata.df.epsilon.to_numpy()[idxes])
+                                           Fcs[idxes], hkldata.binned_df.loc[i_bin, D_labs],
+                                           centric_and_1[idxes], epsilon[idxes])
                 S2 = S2mat[:,idxes]
                 g += -numpy.nansum(S2 * r[:,0], axis=1) # k_ani is already multiplied in r
             return numpy.dot(g, adpdirs.T)
@@ -951,10 +956,10 @@ def determine_ml_params(hkldata, use_int, fc_labs, D_labs, b_aniso, centric_and_
             g = numpy.zeros(6)
             H = numpy.zeros((6, 6))
             for i_bin, idxes in hkldata.binned():
-                r = integr.ll_int_der1_ani(hkldata.df.I.to_numpy()[idxes], hkldata.df.SIGI.to_numpy()[idxes],
+                r = integr.ll_int_der1_ani(Io[idxes], sigIo[idxes],
                                            k_ani[idxes], hkldata.binned_df.loc[i_bin, "S"],
-                                           hkldata.df[fc_labs].to_numpy()[idxes], list(hkldata.binned_df.loc[i_bin, D_labs]),
-                                           hkldata.df.centric.to_numpy()[idxes]+1, hkldata.df.epsilon.to_numpy()[idxes])
+                                           Fcs[idxes], list(hkldata.binned_df.loc[i_bin, D_labs]),
+                                           centric_and_1[idxes], epsilon[idxes])
                 S2 = S2mat[:,idxes]
                 g += -numpy.nansum(S2 * r[:,0], axis=1) # k_ani is already multiplied in r
                 H += numpy.nansum(numpy.matmul(S2[None,:].T, S2.T[:,None]) * (r[:,0]**2)[:,None,None], axis=0)